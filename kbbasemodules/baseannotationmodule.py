@@ -4,34 +4,351 @@ import logging
 import os
 import sys
 import json
+import time
+import hashlib
+import itertools
+import shlex
+import signal
+import subprocess
+import numpy as np
 import pandas as pd
-from Bio.Seq import Seq
-from Bio.Alphabet import IUPAC, _verify_alphabet
+from pandas.api.types import union_categoricals
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from kbbasemodules.basemodule import BaseModule
+from kbbasemodules.proteinvalidator import is_valid_protein
 from os.path import exists
 
 logger = logging.getLogger(__name__)
 
+def run_shell_command(command,timeout=None):
+    #Running in a new session so the whole process group can be killed when the timeout expires
+    process = subprocess.Popen(command,shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,start_new_session=True)
+    try:
+        stderr = process.communicate(timeout=timeout)[1]
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid,signal.SIGKILL)
+        process.communicate()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError("Command exited with code "+str(process.returncode)+": "+stderr.decode(errors="replace")[-1000:])
+
+class AnnotationTable:
+    """
+    Gene annotations stored as a table with categorical gene, ontology, term and name columns plus
+    one float column per score type, in place of nested gene->ontology->term dicts
+    """
+    key_columns = ["gene","ontology","term","name"]
+    
+    def __init__(self):
+        self.frames = []
+        self._table = None
+    
+    @staticmethod
+    def from_dict(annotations):
+        """Builds a table from the gene->ontology->term->{"scores","name"} format"""
+        table = AnnotationTable()
+        columns = {"gene":[],"ontology":[],"term":[],"name":[]}
+        scores = {}
+        for geneid,gene_annotations in annotations.items():
+            for ontology,terms in gene_annotations.items():
+                for term,term_data in terms.items():
+                    index = len(columns["gene"])
+                    columns["gene"].append(geneid)
+                    columns["ontology"].append(ontology)
+                    columns["term"].append(term)
+                    columns["name"].append(term_data.get("name"))
+                    for score_type,value in term_data.get("scores",{}).items():
+                        scores.setdefault(score_type,[]).append((index,value))
+        for score_type in scores:
+            columns[score_type] = np.full(len(columns["gene"]),np.nan)
+            for (index,value) in scores[score_type]:
+                columns[score_type][index] = value
+        table.add_rows(**columns)
+        return table
+    
+    def add_rows(self,gene,ontology,term,name=None,**scores):
+        """Appends parallel arrays of annotations, with scores passed as score_type=array keywords"""
+        frame = pd.DataFrame({"gene":gene,"ontology":ontology,"term":term})
+        frame["name"] = name
+        for key in self.key_columns:
+            frame[key] = frame[key].astype("category")
+        for score_type in scores:
+            frame[score_type] = np.asarray(scores[score_type],dtype=float)
+        self.frames.append(frame)
+        self._table = None
+    
+    @property
+    def table(self):
+        if self._table is None:
+            #Combining columns directly instead of through pd.concat, leaving out empty partitions
+            frames = [frame for frame in self.frames if len(frame) > 0]
+            score_columns = list(dict.fromkeys(column for frame in self.frames for column in frame.columns if column not in self.key_columns))
+            if len(frames) == 1 and all(column in frames[0] for column in score_columns):
+                table = frames[0]
+            else:
+                columns = {}
+                for key in self.key_columns:
+                    columns[key] = union_categoricals([frame[key] for frame in frames]) if len(frames) > 0 else pd.Categorical([])
+                for column in score_columns:
+                    columns[column] = np.concatenate([frame[column].to_numpy() if column in frame else np.full(len(frame),np.nan) for frame in frames]) if len(frames) > 0 else np.empty(0)
+                table = pd.DataFrame(columns)
+            self.frames = [table]
+            self._table = table
+        return self._table
+    
+    def score_columns(self):
+        return [column for column in self.table.columns if column not in self.key_columns]
+    
+    def genes(self):
+        return self.table["gene"].unique().tolist()
+    
+    def __len__(self):
+        return len(self.table)
+    
+    def expand_genes(self,gene_map,drop=set()):
+        """Returns a new table with each gene in gene_map replaced by all of its mapped IDs, dropping genes in drop"""
+        table = self.table
+        sources = [gene for gene in gene_map for i in range(len(gene_map[gene]))]
+        targets = [target for gene in gene_map for target in sorted(gene_map[gene])]
+        mapped = table[table["gene"].isin(sources)].merge(pd.DataFrame({"gene":sources,"target":targets}),on="gene")
+        mapped["gene"] = mapped.pop("target")
+        kept = table[~table["gene"].isin(sources) & ~table["gene"].isin(drop)]
+        output = AnnotationTable()
+        output.add_rows(**{column:kept[column].astype(object).to_numpy() for column in kept.columns})
+        output.add_rows(**{column:mapped[column].astype(object).to_numpy() for column in kept.columns})
+        return output
+    
+    def ontology_terms(self,suffix=""):
+        """Yields (ontology,{gene:[term data]}) in the annotation event payload format"""
+        table = self.table
+        score_columns = self.score_columns()
+        for ontology,rows in table.groupby("ontology",observed=True,sort=False):
+            ontology_terms = {}
+            scores = [rows[column].to_numpy() for column in score_columns]
+            for i,(geneid,term,name) in enumerate(zip(rows["gene"].tolist(),rows["term"].tolist(),rows["name"].tolist())):
+                anno_data = {"term": term}
+                term_scores = {}
+                for j,column in enumerate(score_columns):
+                    if not np.isnan(scores[j][i]):
+                        term_scores[column] = float(scores[j][i])
+                if len(term_scores) > 0:
+                    anno_data["evidence"] = {"scores":term_scores}
+                if isinstance(name,str):
+                    anno_data["name"] = name+suffix
+                ontology_terms.setdefault(geneid,[]).append(anno_data)
+            yield ontology,ontology_terms
+
 class BaseAnnotationModule(BaseModule):
     def __init__(self,name,config,module_dir="/kb/module",working_dir=None,token=None,clients={},callback=None):
         BaseModule.__init__(self,name,config,module_dir,working_dir,token,clients,callback)
         self.version = "0.1.1.am"
+        self.validate_args(self.config,[],{
+            "annotation_chunk_size":500000
+        })
+        self.upload_executor = None
         self.object_info_hash = {}
+        self.protein_hashes = set()
+        self.protein_hash_features = {}
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
     
+    def object_infos(self,refs,chunk_size=1000):
+        """Returns object infos for refs, fetching any not already in object_info_hash through batched
+        get_object_info3 calls so saving annotations never requires downloading the full objects
+        """
+        missing = []
+        for ref in dict.fromkeys(refs):
+            if ref in self.object_info_hash:
+                continue
+            local_data = self.load_local_object(ref,self.ws_id)
+            if local_data:
+                self.object_info_hash[ref] = local_data["info"]
+            else:
+                missing.append(ref)
+        for i in range(0,len(missing),chunk_size):
+            chunk = missing[i:i+chunk_size]
+            infos = self.ws_client().get_object_info3({
+                "objects":[self.process_ws_ids(ref,self.ws_id) for ref in chunk],
+                "includeMetadata":1
+            })["infos"]
+            for j,ref in enumerate(chunk):
+                self.object_info_hash[ref] = infos[j]
+        return [self.object_info_hash[ref] for ref in refs]
+    
+    def object_info(self,ref):
+        return self.object_infos([ref])[0]
+    
     def object_to_proteins(self,ref):
-        output = self.get_object(ref,self.ws_id)
+        return [[ftr_id,seq] for (ftr_id,seq) in self.stream_proteins(ref)]
+    
+    def stream_proteins(self,ref):
+        """Yields (feature_id,protein_translation) pairs for every valid protein in the object
+        
+        Only feature IDs and translations are requested from the workspace, and sequences are
+        checked against the IUPAC protein alphabet without building a sequence list in memory
+        """
+        output = self.load_local_object(ref,self.ws_id)
+        if not output:
+            objspec = self.process_ws_ids(ref,self.ws_id)
+            objspec["included"] = ["/features/[*]/id","/features/[*]/protein_translation"]
+            output = self.ws_get_objects({"objects":[objspec]})["data"][0]
         self.object_info_hash[ref] = output["info"]
-        sequence_list = []
         #TODO: add support for other object types
-        if "features" in output["data"]:
-            for ftr in output["data"]["features"]:
-                if "protein_translation" in ftr:
-                    if len(ftr["protein_translation"]) > 0 and _verify_alphabet(Seq(ftr["protein_translation"], IUPAC.protein)):
-                        sequence_list.append([ftr["id"],ftr["protein_translation"]])
+        for ftr in output["data"].get("features",[]):
+            if "protein_translation" in ftr and is_valid_protein(ftr["protein_translation"]):
+                yield ftr["id"],ftr["protein_translation"]
+    
+    def proteins_to_fasta(self,ref,filename):
+        """Writes the proteins of the object directly to a FASTA file and returns the sequence count"""
+        count = 0
+        with open(filename, 'w') as f:
+            for (ftr_id,seq) in self.stream_proteins(ref):
+                f.write(">"+ftr_id+"\n"+seq+"\n")
+                count += 1
+        return count
+    
+    def export_protein_shards(self,source,max_sequences=100000,max_bytes=None,directory=None,prefix="proteins"):
+        """Writes proteins into sharded FASTA files and returns a manifest of the shards
+        
+        Parameters
+        ----------
+        string or list<string> or iterable<(string id,string sequence)> - source
+            Object reference(s) to stream proteins from, or any iterable of (id,sequence) pairs such as
+            the output of unique_proteins
+        int - max_sequences
+            Maximum number of sequences per shard
+        int - max_bytes
+            Maximum FASTA size in bytes per shard
+        Returns
+        -------
+        dict
+            {"directory":string,"sequences":int,"shards":[{"file","sequences","bytes"}]}
+        """
+        if isinstance(source,str):
+            source = [source]
+        source = iter(source)
+        first = next(source,None)
+        if isinstance(first,str):
+            refs = [first]+list(source)
+            source = (item for ref in refs for item in self.stream_proteins(ref))
+        elif first is not None:
+            source = itertools.chain([first],source)
+        if not directory:
+            directory = self.working_dir+"/"+prefix
+        os.makedirs(directory, exist_ok=True)
+        manifest = {"directory":directory,"sequences":0,"shards":[]}
+        shard = None
+        f = None
+        for (ftr_id,seq) in source:
+            record = ">"+ftr_id+"\n"+seq+"\n"
+            if shard and (shard["sequences"] >= max_sequences or (max_bytes and shard["bytes"]+len(record) > max_bytes)):
+                f.close()
+                shard = None
+            if not shard:
+                shard = {"file":directory+"/"+prefix+"."+str(len(manifest["shards"])).zfill(4)+".faa","sequences":0,"bytes":0}
+                manifest["shards"].append(shard)
+                f = open(shard["file"], 'w')
+            f.write(record)
+            shard["sequences"] += 1
+            shard["bytes"] += len(record)
+            manifest["sequences"] += 1
+        if f:
+            f.close()
+        with open(directory+"/manifest.json", 'w') as f:
+            json.dump(manifest,f,indent=4)
+        return manifest
+    
+    def run_shard_command(self,manifest,command,parser,threads=None,timeout=None,output_suffix=".out",annotations=None):
+        """Runs an external annotation tool over every shard in a manifest from export_protein_shards
+        
+        Parameters
+        ----------
+        dict - manifest
+            Shard manifest returned by export_protein_shards
+        string - command
+            Shell command template with {input} and {output} placeholders for the shard and its output file.
+            Only these two placeholders are substituted, so other braces (awk, jq) are passed through as is
+        function - parser
+            parser(output_file) yielding (gene_id,ontology,term,{"scores":dict,"name":string}) tuples.
+            Annotations from a shard are only kept if the command and the parser both succeed
+        int - timeout
+            Seconds after which a shard command is killed and reported as failed
+        Returns
+        -------
+        dict
+            {"annotations":gene->ontology->term->data for add_annotations_to_object,"failed":{shard file:error}}
+        """
+        if not threads:
+            threads = self.config["max_threads"]
+        if annotations is None:
+            annotations = {}
+        output = {"annotations":annotations,"failed":{}}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {}
+            for shard in manifest["shards"]:
+                output_file = shard["file"]+output_suffix
+                shard_command = command.replace("{input}",shlex.quote(shard["file"])).replace("{output}",shlex.quote(output_file))
+                futures[executor.submit(run_shell_command,shard_command,timeout)] = (shard["file"],output_file)
+            #Parsing each shard as soon as it finishes while the remaining shards keep running
+            for count,future in enumerate(as_completed(futures)):
+                (shard_file,output_file) = futures[future]
+                shard_annotations = {}
+                try:
+                    future.result()
+                    for (geneid,ontology,term,term_data) in parser(output_file):
+                        shard_annotations.setdefault(geneid,{}).setdefault(ontology,{})[term] = term_data
+                except Exception as e:
+                    error = "timed out after "+str(timeout)+" seconds" if isinstance(e,subprocess.TimeoutExpired) else str(e)
+                    logger.warning("Annotation command failed for "+shard_file+": "+error)
+                    output["failed"][shard_file] = error
+                    continue
+                for geneid in shard_annotations:
+                    for ontology in shard_annotations[geneid]:
+                        annotations.setdefault(geneid,{}).setdefault(ontology,{}).update(shard_annotations[geneid][ontology])
+                logger.info("Parsed "+str(count+1)+" of "+str(len(futures))+" shards: "+shard_file)
+        return output
+    
+    def unique_proteins(self,refs):
+        """Returns [[md5,sequence]] for each distinct protein across all input objects
+        
+        Identical proteins from different features or genomes in this call are sent to annotators only
+        once, while the features sharing each hash are recorded so annotations can be fanned back out on
+        save. Each call dedups on its own, and the hash map of every input object is rebuilt from scratch.
+        """
+        sequence_list = []
+        seen = set()
+        for ref in refs:
+            hash_features = {}
+            for (ftr_id,seq) in self.stream_proteins(ref):
+                md5 = hashlib.md5(seq.encode("ascii")).hexdigest()
+                if md5 not in seen:
+                    seen.add(md5)
+                    sequence_list.append([md5,seq])
+                hash_features.setdefault(md5,set()).add(ftr_id)
+            self.protein_hash_features[ref] = hash_features
+        #All hashes ever issued are kept so hash keys belonging to other objects are dropped on save
+        self.protein_hashes.update(seen)
         return sequence_list
     
+    def expand_protein_hashes(self,reference,annotations):
+        """Replaces protein hash keys in annotations with the feature IDs of reference sharing each hash
+        
+        Hash keys issued by unique_proteins for other objects are dropped even when reference has no hashes
+        """
+        if reference not in self.protein_hash_features and len(self.protein_hashes) == 0:
+            return annotations
+        hash_features = self.protein_hash_features.get(reference,{})
+        if isinstance(annotations,AnnotationTable):
+            return annotations.expand_genes(hash_features,self.protein_hashes)
+        output = {}
+        for key in annotations:
+            if key in hash_features:
+                for ftr_id in sorted(hash_features[key]):
+                    output[ftr_id] = annotations[key]
+            elif key not in self.protein_hashes:
+                output[key] = annotations[key]
+        return output
+    
     def add_annotations_to_object(self,reference,suffix,annotations):
         """Loads specified gene annotation into KBase genome object
         
@@ -42,7 +359,8 @@ class BaseAnnotationModule(BaseModule):
         string - suffix
             Suffix to be used when saving modified genome back to KBase
         mapping<string gene_id,mapping<string ontology,mapping<string term,{"type":string,"score":float}>>> - annotations
-            Annotations to be saved to genome
+            Annotations to be saved to genome, keyed by gene ID or by protein hash from unique_proteins,
+            either in this format or as an AnnotationTable
         Returns
         -------
         dict
@@ -50,38 +368,133 @@ class BaseAnnotationModule(BaseModule):
         Raises
         ------
         """
-        ontology_inputs = {}
-        for geneid in annotations:
-            for ontology in annotations[geneid]:
-                if ontology not in ontology_inputs:
-                    ontology_inputs[ontology] = {}
-                if geneid not in ontology_inputs[ontology]:
-                    ontology_inputs[ontology][geneid] = []
-                for term in annotations[geneid][ontology]:
-                    anno_data = {"term": term}
-                    if "scores" in annotations[geneid][ontology][term]:
-                        anno_data["evidence"] = {"scores":annotations[geneid][ontology][term]["scores"]}
-                    if "name" in annotations[geneid][ontology][term]:
-                        anno_data["name"] = annotations[geneid][ontology][term]["name"]+suffix
-                    ontology_inputs[ontology][geneid].append(anno_data)
-                        
+        anno_api_output = self.save_annotation_input(self.annotation_api_input(reference,suffix,annotations))
+        self.obj_created.append({"ref":anno_api_output["output_ref"],"description":"Saving annotation for "+self.object_info(reference)[1]})
+        return anno_api_output
+    
+    def submit_annotations_to_object(self,reference,suffix,annotations):
+        """Queues add_annotations_to_object on a background upload thread and returns its future
+        
+        Uploads run one at a time in submission order, so callers can keep computing annotations for
+        the next object while the previous one is saved
+        """
+        if not self.upload_executor:
+            self.upload_executor = ThreadPoolExecutor(max_workers=1)
+        return self.upload_executor.submit(self.add_annotations_to_object,reference,suffix,annotations)
+    
+    def add_annotations_to_objects(self,reference_annotations,suffix,threads=None):
+        """Batch version of add_annotations_to_object for a list of (reference,annotations) pairs
+        
+        Event payloads are built up front and submitted concurrently, while outputs and obj_created
+        entries are kept in input order
+        """
+        if not threads:
+            threads = self.config["max_threads"]
+        self.object_infos([reference for (reference,annotations) in reference_annotations])
+        anno_api_inputs = [self.annotation_api_input(reference,suffix,annotations) for (reference,annotations) in reference_annotations]
+        self.anno_client()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            anno_api_outputs = list(executor.map(self.save_annotation_input,anno_api_inputs))
+        for i,(reference,annotations) in enumerate(reference_annotations):
+            self.obj_created.append({"ref":anno_api_outputs[i]["output_ref"],"description":"Saving annotation for "+self.object_info(reference)[1]})
+        return anno_api_outputs
+    
+    def annotation_api_input(self,reference,suffix,annotations):
         anno_api_input = {
             "input_ref":reference,
-            "output_name":self.object_info_hash[reference][1]+suffix,
+            "output_name":self.object_info(reference)[1]+suffix,
             "output_workspace":self.ws_id,
             "overwrite_matching":1,
             "save":1,
             "provenance":self.provenance(),
-            "events":[]
+            "events":self.build_annotation_events(self.expand_protein_hashes(reference,annotations),suffix)
         }
-        for ontology in ontology_inputs.keys():
-            anno_api_input["events"].append({
+        return anno_api_input
+    
+    def build_annotation_events(self,annotations,suffix):
+        #Single pass over the gene annotations, grouping terms by ontology as they are encountered
+        ontology_inputs = {}
+        if isinstance(annotations,AnnotationTable):
+            ontology_inputs = dict(annotations.ontology_terms(suffix))
+            annotations = {}
+        for geneid,gene_annotations in annotations.items():
+            for ontology,terms in gene_annotations.items():
+                gene_terms = ontology_inputs.setdefault(ontology,{}).setdefault(geneid,[])
+                for term,term_data in terms.items():
+                    anno_data = {"term": term}
+                    if "scores" in term_data:
+                        anno_data["evidence"] = {"scores":term_data["scores"]}
+                    if "name" in term_data:
+                        anno_data["name"] = term_data["name"]+suffix
+                    gene_terms.append(anno_data)
+        events = []
+        for ontology in ontology_inputs:
+            events.append({
                 "ontology_id":ontology,
                 "method":self.name+"."+self.method,
                 "method_version":self.version,
                 "timestamp":self.timestamp,
                 "ontology_terms":ontology_inputs[ontology]
             })
-        anno_api_output = self.anno_client().add_annotation_ontology_events(anno_api_input)
-        self.obj_created.append({"ref":anno_api_output["output_ref"],"description":"Saving annotation for "+self.object_info_hash[reference][1]})
-        return anno_api_output
\ No newline at end of file
+        return events
+    
+    def save_annotation_input(self,anno_api_input):
+        """Saves annotation events, splitting payloads over annotation_chunk_size gene terms into chunks
+        
+        Each chunk holds a gene range from a single ontology saved as its own event with an explicit
+        event_id, on top of the object version written by the previous chunk, so only the final output
+        is returned. Readers such as get_gene_term_hash combine terms across all events of an ontology.
+        """
+        term_count = 0
+        for event in anno_api_input["events"]:
+            term_count += sum(len(gene_terms) for gene_terms in event["ontology_terms"].values())
+        if term_count <= self.config["annotation_chunk_size"]:
+            return self.anno_api_add_events(anno_api_input)
+        chunks = self.chunk_annotation_events(anno_api_input["events"],self.config["annotation_chunk_size"])
+        input_ref = anno_api_input["input_ref"]
+        for i,event in enumerate(chunks):
+            chunk_input = dict(anno_api_input,input_ref=input_ref,events=[event])
+            anno_api_output = self.anno_api_add_events(chunk_input)
+            input_ref = anno_api_output["output_ref"]
+            logger.info("Saved annotation chunk %d of %d for %s (%s, %d genes)",
+                i+1, len(chunks), anno_api_input["output_name"], event["ontology_id"], len(event["ontology_terms"]))
+        return anno_api_output
+    
+    def chunk_annotation_events(self,events,chunk_size):
+        #Splitting each ontology event into gene ranges holding at most chunk_size gene terms, each given
+        #a distinct event_id so no range can match, replace or be merged into another on the server
+        chunks = []
+        for event in events:
+            ranges = []
+            current = {}
+            count = 0
+            for geneid,gene_terms in event["ontology_terms"].items():
+                if count > 0 and count+len(gene_terms) > chunk_size:
+                    ranges.append(current)
+                    current = {}
+                    count = 0
+                current[geneid] = gene_terms
+                count += len(gene_terms)
+            if len(current) > 0:
+                ranges.append(current)
+            base_id = event.get("event_id",event["method"]+":"+event["method_version"]+":"+event["ontology_id"]+":"+event["timestamp"])
+            for i,ontology_terms in enumerate(ranges):
+                chunks.append(dict(event,event_id=base_id+":"+str(i+1)+"/"+str(len(ranges)),ontology_terms=ontology_terms))
+        return chunks
+    
+    def anno_api_add_events(self,anno_api_input):
+        """
+        All calls to add_annotation_ontology_events should go through this function to ensure they get
+        the retry code because large annotation saves periodically time out
+        """
+        tries = 0
+        while True:
+            try:
+                return self.anno_client().add_annotation_ontology_events(anno_api_input)
+            except Exception as e:
+                tries += 1
+                if tries >= self.config["max_retry"]:
+                    raise
+                logger.warning("add_annotation_ontology_events call failed for %s. Trying again! Error: %s",
+                    anno_api_input["output_name"], str(e))
+                time.sleep(10)
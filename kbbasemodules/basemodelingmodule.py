@@ -4,6 +4,9 @@ import logging
 import os
 import sys
 import json
+import time
+import numpy as np
+import pandas as pd
 import cobrakbase
 from kbbasemodules.basemodule import BaseModule
 import cobra
@@ -20,6 +23,11 @@ from modelseedpy.core.msgrowthphenotypes import MSGrowthPhenotypes
 from modelseedpy.core.msgenomeclassifier import MSGenomeClassifier
 from cobrakbase.core.kbasefba.fbamodel_from_cobra import CobraModelConverter
 from cobrakbase.core.kbasefba import FBAModel
+from cobrakbase.core.kbasefba.fbamodel_reaction import ModelReaction
+from cobrakbase.core.kbasegenomesgenome import KBaseGenomeFeature
+from cobrakbase.core.kbase_object_factory import KBaseObjectFactory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 from os.path import exists
 import pickle
 
@@ -27,6 +35,210 @@ logger = logging.getLogger(__name__)
 
 excluded_cpd = ["cpd22290","cpd11850"]
 
+classifier_cache = {}
+
+batch_worker_state = {}
+
+def run_batch_build_worker(genome_ref):
+    #Runs in a forked worker process using the module state inherited from the parent
+    module = batch_worker_state["module"]
+    start = len(module.input_objects)
+    try:
+        mdlutl = batch_worker_state["build_function"](module,genome_ref,batch_worker_state["templates"])
+        #Freshly built models have no workspace ID, so falling back on the model ID and then the genome name
+        objid = mdlutl.wsid or mdlutl.model.id or genome_ref.split("/")[-2 if genome_ref.count("/") == 2 else -1]
+        objid,data = module.prepare_model_data(mdlutl,objid=objid,suffix=batch_worker_state["suffix"],gapfilling_data=batch_worker_state["gapfilling_data"])
+    except Exception as e:
+        logger.warning("Model build failed for "+genome_ref, exc_info=True)
+        return {"error":str(e)}
+    return {"id":objid,"data":data,"input_objects":module.input_objects[start:]}
+
+simulation_worker_state = {}
+
+def run_simulation_worker(indices):
+    #Reuses one model and solver for every condition in the chunk, changing only bounds between solves
+    results = []
+    with SimulationContext(simulation_worker_state["mdlutl"]) as context:
+        for index in indices:
+            condition = simulation_worker_state["conditions"][index]
+            context.apply_media(condition["media"])
+            status,objective,fluxes = context.optimize(condition["gene_ko"],simulation_worker_state["save_fluxes"])
+            results.append((index,status,objective,fluxes))
+    return results
+
+class SimulationContext:
+    """
+    Keeps the solver problem of a model alive across conditions. Media are applied as deltas on the
+    exchange bounds and presolve is disabled, so each solve warm starts from the previous basis.
+    """
+    def __init__(self,mdlutl):
+        self.model = mdlutl.model
+        exchange_hash = mdlutl.exchange_hash()
+        self.exchanges = {met.id:exchange_hash[met] for met in exchange_hash}
+        self.original_bounds = {met_id:self.exchanges[met_id].bounds for met_id in self.exchanges}
+        self.current_bounds = dict(self.original_bounds)
+        self.original_presolve = self.model.solver.configuration.presolve
+        self.model.solver.configuration.presolve = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+    
+    def apply_media(self,media_constraints):
+        #Only exchanges whose bounds differ from the previous condition are touched
+        changed = 0
+        for met_id in self.exchanges:
+            if met_id in media_constraints:
+                bounds = tuple(media_constraints[met_id])
+            else:
+                bounds = (0,self.original_bounds[met_id][1])
+            if bounds != self.current_bounds[met_id]:
+                self.exchanges[met_id].bounds = bounds
+                self.current_bounds[met_id] = bounds
+                changed += 1
+        return changed
+    
+    def optimize(self,gene_ko=[],save_fluxes=False):
+        fluxes = None
+        with self.model:
+            for gene_id in gene_ko:
+                if gene_id in self.model.genes:
+                    self.model.genes.get_by_id(gene_id).knock_out()
+            if save_fluxes:
+                solution = self.model.optimize()
+                status = solution.status
+                objective = solution.objective_value
+                fluxes = solution.fluxes.values
+            else:
+                objective = self.model.slim_optimize(error_value=np.nan)
+                status = self.model.solver.status
+        if status != "optimal":
+            return status,np.nan,None
+        return status,objective,fluxes
+    
+    def close(self):
+        for met_id in self.exchanges:
+            if self.current_bounds[met_id] != self.original_bounds[met_id]:
+                self.exchanges[met_id].bounds = self.original_bounds[met_id]
+        self.current_bounds = dict(self.original_bounds)
+        self.model.solver.configuration.presolve = self.original_presolve
+
+class FBASolutionSet:
+    """
+    Columnar store for many FBA solutions of one model. Fluxes are kept as NumPy rows aligned to a
+    shared reaction index, and KBase variable records are only produced when the FBA is saved.
+    """
+    def __init__(self,reaction_ids):
+        self.reaction_index = pd.Index(reaction_ids)
+        self.ids = []
+        self.statuses = []
+        self.objective_values = []
+        self.rows = []
+        self._matrix = None
+    
+    @staticmethod
+    def from_flux_table(fluxes,summary=None):
+        #Builds a set from the condition by reaction flux table returned by simulate_conditions
+        solution_set = FBASolutionSet(fluxes.columns)
+        solution_set.ids = list(fluxes.index)
+        solution_set.rows = list(fluxes.values)
+        if summary is not None:
+            solution_set.statuses = list(summary.loc[fluxes.index,"status"])
+            solution_set.objective_values = list(summary.loc[fluxes.index,"objective"])
+        else:
+            solution_set.statuses = ["optimal"]*len(fluxes.index)
+            solution_set.objective_values = [np.nan]*len(fluxes.index)
+        return solution_set
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def add_solution(self,solution,solution_id=None):
+        if solution_id == None:
+            solution_id = str(len(self.rows))
+        self.ids.append(solution_id)
+        self.statuses.append(solution.status)
+        self.objective_values.append(solution.objective_value)
+        self.rows.append(solution.fluxes.reindex(self.reaction_index,fill_value=0).values)
+        self._matrix = None
+    
+    @property
+    def matrix(self):
+        if self._matrix is None or len(self._matrix) != len(self.rows):
+            self._matrix = np.vstack(self.rows) if len(self.rows) > 0 else np.empty((0,len(self.reaction_index)))
+        return self._matrix
+    
+    def to_solution(self,index):
+        return cobra.Solution(
+            self.objective_values[index],
+            self.statuses[index],
+            fluxes=pd.Series(self.matrix[index],index=self.reaction_index)
+        )
+    
+    def optimal_indices(self):
+        #Failed conditions carry NaN fluxes and objectives, which are not valid JSON for the workspace
+        return [i for i,status in enumerate(self.statuses) if status == "optimal" and not np.isnan(self.objective_values[i])]
+    
+    def fill_kbase_variables(self,data):
+        #Fills other_values on every variable record of the FBA data in one vectorized pass over the
+        #flux matrix, leaving out non-optimal solutions
+        variables = []
+        rxn_ids = []
+        signs = []
+        for key,ref_field,prefix,sign in [
+            ("FBAReactionVariables","modelreaction_ref","",1),
+            ("FBABiomassVariables","biomass_ref","",1),
+            ("FBACompoundVariables","modelcompound_ref","EX_",-1)
+        ]:
+            for variable in data.get(key,[]):
+                if ref_field in variable:
+                    rxn_id = prefix+variable[ref_field].split("/")[-1]
+                    if rxn_id in self.reaction_index:
+                        variables.append(variable)
+                        rxn_ids.append(rxn_id)
+                        signs.append(sign)
+        indices = self.optimal_indices()
+        if len(indices) < len(self.rows):
+            logger.warning(str(len(self.rows)-len(indices))+" non-optimal solutions left out of saved FBA: "+", ".join(str(self.ids[i]) for i in range(len(self.rows)) if i not in set(indices)))
+        if len(variables) > 0:
+            columns = self.reaction_index.get_indexer(rxn_ids)
+            matrix = np.nan_to_num(self.matrix[indices][:,columns])
+            values = (matrix*np.array(signs)+0.0).T.tolist()
+            for i,variable in enumerate(variables):
+                variable["other_values"] = values[i]
+        data["numberOfSolutions"] = 1+len(indices)
+        return data
+
+class StagedModelEdit:
+    """
+    Collects new metabolites and reactions for a model so they can be applied in one bulk
+    add with a single solver update, instead of updating the model object by object
+    """
+    def __init__(self,model):
+        self.model = model
+        self.metabolites = {}
+        self.reactions = {}
+    
+    def add_metabolite(self,metabolite):
+        if metabolite.id not in self.metabolites and metabolite.id not in self.model.metabolites:
+            self.metabolites[metabolite.id] = metabolite
+    
+    def add_reaction(self,reaction):
+        if reaction.id not in self.reactions and reaction.id not in self.model.reactions:
+            self.reactions[reaction.id] = reaction
+    
+    def apply(self):
+        #Metabolites go in first so add_reactions relinks reaction metabolites to the model copies
+        self.model.add_metabolites(list(self.metabolites.values()))
+        self.model.add_reactions(list(self.reactions.values()))
+        self.model.solver.update()
+        output = {"metabolites":len(self.metabolites),"reactions":len(self.reactions)}
+        self.metabolites = {}
+        self.reactions = {}
+        return output
+
 class BaseModelingModule(BaseModule):
     def __init__(self,name,config,module_dir="/kb/module",working_dir=None,token=None,clients={},callback=None):
         BaseModule.__init__(self,name,config,module_dir=module_dir,working_dir=working_dir,token=token,clients=clients,callback=callback)
@@ -36,6 +248,7 @@ class BaseModelingModule(BaseModule):
         self.kbase_api = cobrakbase.KBaseAPI(token=token)
         #self.kbase_api = cobrakbase.KBaseCache(token=token,dev=True)
         self.kbase_api.ws_client = self.ws_client()
+        self.feature_indexes = {}
         #Loading default biochemistry
         if "modelseedbiochem_directory" not in self.config or not self.config["modelseedbiochem_directory"]:
             #Setting location of ModelSEEDBiochem on Sequoia as the default, as that is where the most diverse users are
@@ -69,8 +282,6 @@ class BaseModelingModule(BaseModule):
     def process_media_list(self,media_list,default_media,workspace):
         if not media_list:
             media_list = []
-        #Retrieving media objects from references
-        media_objects = []
         first = True
         #Cleaning out empty or invalid media references
         original_list = media_list
@@ -91,25 +302,77 @@ class BaseModelingModule(BaseModule):
         #Making sure default gapfilling media is complete media
         if not media_list or len(media_list) == 0:
             media_list = [default_media]            
-        #Retrieving media objects        
-        for media_ref in media_list:  
-            media = self.get_media(media_ref,None)
-            media_objects.append(media)
-        return media_objects
-    
-    def create_minimal_medias(self,carbon_list,workspace,base_media="KBaseMedia/Carbon-D-Glucose"):
-        data = self.get_object(base_media)["data"]
+        #Retrieving media objects in a single batched call
+        return self.get_medias(media_list)
+    
+    def create_minimal_medias(self,carbon_list,workspace,base_media="KBaseMedia/Carbon-D-Glucose",chunk_size=100):
+        data = self.get_object(base_media,None,"KBaseBiochem.Media")["data"]
+        medias = []
         for item in carbon_list:
-            self.save_json("Carbon-"+item,data)
-            copy = self.load_json("Carbon-"+item)
-            copy["id"] = "Carbon-"+item
-            copy["name"] = "Carbon-"+item
-            copy["source_id"] = "Carbon-"+item
-            copy["type"] = "MinimalCarbon"
-            for cpd in copy["mediacompounds"]:
-                if cpd["compound_ref"].split("/")[-1] == "cpd00027":
-                    cpd["compound_ref"] = cpd["compound_ref"].replace("cpd00027",carbon_list[item])
-            self.save_ws_object("Carbon-"+item,workspace,copy,"KBaseBiochem.Media")
+            media = self.build_templated_media(data,"Carbon-"+item,{"cpd00027":carbon_list[item]})
+            medias.append(("Carbon-"+item,media,"KBaseBiochem.Media"))
+        return self.save_ws_objects(medias,workspace,chunk_size)
+    
+    def build_templated_media(self,template,media_id,compound_replacements,media_type="MinimalCarbon"):
+        #Structural copy: only the top level and media compound records are modified, so nothing else is copied
+        media = dict(template)
+        media["id"] = media_id
+        media["name"] = media_id
+        media["source_id"] = media_id
+        media["type"] = media_type
+        media["mediacompounds"] = []
+        for cpd in template["mediacompounds"]:
+            cpd = dict(cpd)
+            cpd_id = cpd["compound_ref"].split("/")[-1]
+            if cpd_id in compound_replacements:
+                cpd["compound_ref"] = cpd["compound_ref"].replace(cpd_id,compound_replacements[cpd_id])
+            media["mediacompounds"].append(cpd)
+        return media
+    
+    #################Batch reconstruction functions#####################
+    def batch_build_models(self,genome_refs,build_function,workspace=None,suffix=None,templates=None,threads=None,chunk_size=20):
+        """
+        Builds models for a list of genomes in a pool of worker processes forked from this one, so
+        every worker starts with the biochemistry, templates and clients already loaded here.
+        build_function(module,genome_ref,templates) must return an MSModelUtil. Models are saved under
+        the MSModelUtil workspace ID, the model ID or the genome name, in that order, plus the suffix.
+        Failures are isolated per genome and reported in the output instead of stopping the batch.
+        """
+        if templates == None:
+            templates = {}
+        if not threads:
+            threads = self.config["max_threads"]
+        batch_worker_state["module"] = self
+        batch_worker_state["build_function"] = build_function
+        batch_worker_state["templates"] = templates
+        batch_worker_state["suffix"] = suffix
+        batch_worker_state["gapfilling_data"] = workspace != None or self.use_local_store()
+        output = {}
+        models = []
+        with ProcessPoolExecutor(max_workers=threads,mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {executor.submit(run_batch_build_worker,ref):ref for ref in genome_refs}
+            for future in as_completed(futures):
+                ref = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error":str(e)}
+                if "error" in result:
+                    logger.warning("Model build failed for "+ref+": "+result["error"])
+                else:
+                    self.input_objects.extend(result["input_objects"])
+                    models.append((result["id"],result["data"],"KBaseFBA.FBAModel"))
+                    result = {"id":result["id"]}
+                output[ref] = result
+                logger.info("Built "+str(len(output))+" of "+str(len(genome_refs))+" models: "+ref)
+        batch_worker_state.clear()
+        #Saving all successfully built models in chunked calls
+        if not workspace and not self.use_local_store():
+            for (objid,data,obj_type) in models:
+                self.print_json_debug_file(objid+".json",data)
+        else:
+            self.save_ws_objects(models,workspace,chunk_size)
+        return output
     
     #################Genome functions#####################
     def annotate_genome_with_rast(self,genome_id,ws=None,output_ws=None):
@@ -123,58 +386,163 @@ class BaseModelingModule(BaseModule):
         })
         return output["workspace"]+"/"+output["id"]
     
+    def annotate_genomes_with_rast(self,genome_infos,output_ws=None,chunk_size=10,threads=None):
+        """
+        Submits genomes to RAST through annotate_genomes in chunks running concurrently, and yields
+        (genome_info,rast_ref) pairs as each chunk completes so callers can resume work on them
+        """
+        if not threads:
+            threads = self.config["max_threads"]
+        #Grouping genomes by output workspace since annotate_genomes takes a single workspace
+        ws_genomes = {}
+        for info in genome_infos:
+            ws = output_ws
+            if not ws:
+                ws = info[6]
+            if ws not in ws_genomes:
+                ws_genomes[ws] = []
+            ws_genomes[ws].append(info)
+        chunks = []
+        for ws in ws_genomes:
+            for i in range(0,len(ws_genomes[ws]),chunk_size):
+                chunks.append((ws,ws_genomes[ws][i:i+chunk_size]))
+        rast_client = self.rast_client()
+        def annotate_chunk(ws,infos):
+            output = rast_client.annotate_genomes({
+                "workspace":ws,
+                "input_genomes":[{"input_genome":self.wsinfo_to_ref(info),"output_genome":info[1]+".RAST"} for info in infos]
+            })
+            return [(info,str(output["workspace"])+"/"+info[1]+".RAST") for info in infos]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(annotate_chunk,ws,infos) for (ws,infos) in chunks]
+            for future in as_completed(futures):
+                for item in future.result():
+                    yield item
+    
+    def load_annotation_ontology(self,gen_ref,annoapi):
+        return AnnotationOntology.from_kbase_data(annoapi.get_annotation_ontology_events({
+            "input_ref" : gen_ref
+        }),gen_ref,self.module_dir+"/data/")
+    
+    def get_genome_functions(self,gen_ref):
+        return self.get_genomes_functions([gen_ref])[0]
+    
+    def get_genomes_functions(self,gen_refs):
+        """
+        Fetches genome infos with only feature IDs and function strings instead of the full genomes,
+        using one batched get_objects2 call for all genomes not found in the local store
+        """
+        output = []
+        ws_indices = []
+        for i,gen_ref in enumerate(gen_refs):
+            output.append(self.load_local_object(gen_ref,None,"KBaseGenomes.Genome"))
+            if not output[i]:
+                ws_indices.append(i)
+        if len(ws_indices) > 0:
+            objspecs = []
+            for i in ws_indices:
+                objspec = self.process_ws_ids(gen_refs[i])
+                objspec["included"] = ["/features/[*]/id","/features/[*]/functions","/features/[*]/function"]
+                objspecs.append(objspec)
+            res = self.ws_get_objects({"objects":objspecs})
+            for j,i in enumerate(ws_indices):
+                output[i] = res["data"][j]
+        for i,ws_data in enumerate(output):
+            functions = {}
+            for ftr in ws_data["data"].get("features",[]):
+                unsplit = ftr.get("functions",[ftr["function"]] if "function" in ftr else [])
+                if isinstance(unsplit,str):
+                    unsplit = [unsplit]
+                functions[ftr["id"]] = KBaseGenomeFeature.split_annotation(unsplit)
+            self.add_input_object(ws_data["info"])
+            output[i] = (ws_data["info"],functions)
+        return output
+    
+    def fetch_genome_annotations(self,gen_ref,annoapi):
+        #Annotation events and genome functions come from different services, so both are fetched concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            annoont = executor.submit(self.load_annotation_ontology,gen_ref,annoapi)
+            genome_functions = executor.submit(self.get_genome_functions,gen_ref)
+            info,functions = genome_functions.result()
+            return annoont.result(),info,functions
+    
     def get_msgenome_from_ontology(self,id_or_ref,ws=None,native_python_api=False,output_ws=None):
         annoapi = self.anno_client(native_python_api=native_python_api)
         gen_ref = self.create_ref(id_or_ref,ws)
-        genome_info = self.get_object_info(gen_ref)
-        annoont = AnnotationOntology.from_kbase_data(annoapi.get_annotation_ontology_events({
-            "input_ref" : gen_ref
-        }),gen_ref,self.module_dir+"/data/")
+        annoont,genome_info,functions = self.fetch_genome_annotations(gen_ref,annoapi)
         gene_term_hash = annoont.get_gene_term_hash(ontologies=["SSO"])
         if len(gene_term_hash) == 0:
             logger.warning("Genome has not been annotated with RAST! Reannotating genome with RAST!")
             gen_ref = self.annotate_genome_with_rast(genome_info[1],genome_info[6],output_ws)
-            annoont = AnnotationOntology.from_kbase_data(annoapi.get_annotation_ontology_events({
-                "input_ref" : gen_ref
-            }),gen_ref,self.module_dir+"/data/")
+            annoont,rast_info,functions = self.fetch_genome_annotations(gen_ref,annoapi)
+        return self.build_msgenome_from_ontology(annoont,genome_info,functions)
+    
+    def get_msgenomes_from_ontology(self,id_or_refs,ws=None,native_python_api=False,output_ws=None,chunk_size=10):
+        """
+        Batch version of get_msgenome_from_ontology yielding (input_ref,genome) pairs. Genomes already
+        annotated with RAST are yielded first, while all genomes lacking SSO terms are submitted to
+        RAST together and yielded as their annotation chunks complete.
+        """
+        annoapi = self.anno_client(native_python_api=native_python_api)
+        gen_refs = [self.create_ref(id_or_ref,ws) for id_or_ref in id_or_refs]
+        needs_rast = []
+        input_refs = {}
+        with ThreadPoolExecutor(max_workers=self.config["max_threads"]) as executor:
+            #Annotation events load concurrently while infos and functions come from batched get_objects2 calls
+            annoonts = executor.map(lambda gen_ref: self.load_annotation_ontology(gen_ref,annoapi),gen_refs)
+            genome_functions = []
+            for i in range(0,len(gen_refs),chunk_size):
+                genome_functions += self.get_genomes_functions(gen_refs[i:i+chunk_size])
+            for i,annoont in enumerate(annoonts):
+                (genome_info,functions) = genome_functions[i]
+                if len(annoont.get_gene_term_hash(ontologies=["SSO"])) == 0:
+                    needs_rast.append(genome_info)
+                    input_refs[self.wsinfo_to_ref(genome_info)] = gen_refs[i]
+                else:
+                    yield gen_refs[i],self.build_msgenome_from_ontology(annoont,genome_info,functions)
+        if len(needs_rast) > 0:
+            logger.warning(str(len(needs_rast))+" genomes have not been annotated with RAST! Reannotating genomes with RAST!")
+            for (genome_info,rast_ref) in self.annotate_genomes_with_rast(needs_rast,output_ws,chunk_size):
+                annoont,rast_info,functions = self.fetch_genome_annotations(rast_ref,annoapi)
+                yield input_refs[self.wsinfo_to_ref(genome_info)],self.build_msgenome_from_ontology(annoont,genome_info,functions)
+    
+    def build_msgenome_from_ontology(self,annoont,genome_info,functions):
         annoont.info = genome_info
-        wsgenome = self.get_msgenome(gen_ref,ws)
         genome = annoont.get_msgenome()
-        for ftr in wsgenome.features:
-            for func in ftr.functions:
-                if ftr.id in genome.features:
-                    genome.features.get_by_id(ftr.id).add_ontology_term("RAST",func)
-                else:
-                    newftr = genome.create_new_feature(ftr.id,"")
-                    newftr.add_ontology_term("RAST",func)
+        #Merging RAST functions through a dict index over the ontology genome features
+        feature_index = {ftr.id:ftr for ftr in genome.features}
+        for ftr_id in functions:
+            for func in functions[ftr_id]:
+                if ftr_id not in feature_index:
+                    feature_index[ftr_id] = genome.create_new_feature(ftr_id,"")
+                feature_index[ftr_id].add_ontology_term("RAST",func)
         genome.id = genome_info[1]
         genome.scientific_name = genome_info[10]["Name"]
         return genome
 
+    def get_feature_index(self,genome_obj):
+        #Feature ID indexes are built once per genome and reused for the rest of the job
+        if genome_obj not in self.feature_indexes:
+            self.feature_indexes[genome_obj] = pd.Index([ftr.id for ftr in genome_obj.features])
+        return self.feature_indexes[genome_obj]
+
     def get_expression_objs(self,expression_refs,genome_objs):
         genomes_to_models_hash = {}
         for mdl in genome_objs:
             genomes_to_models_hash[genome_objs[mdl]] = mdl
-        ftrhash = {}
+        #Fetching expression matrices concurrently
+        with ThreadPoolExecutor(max_workers=self.config["max_threads"]) as executor:
+            expression_list = list(executor.map(lambda ref: self.get_kbase_object(ref,None,"KBaseFeatureValues.ExpressionMatrix"),expression_refs))
         expression_objs = {}
-        for genome_obj in genomes_to_models_hash:
-            for ftr in genome_obj.features:
-                ftrhash[ftr.id] = genome_obj
-        for expression_ref in expression_refs:
-            expression_obj = self.kbase_api.get_from_ws(expression_ref,None)
-            row_ids = expression_obj.row_ids
-            genome_obj_count = {}
-            for ftr_id in row_ids:
-                if ftr_id in ftrhash:
-                    if ftrhash[ftr_id] not in genome_obj_count:
-                        genome_obj_count[ftrhash[ftr_id]] = 0
-                    genome_obj_count[ftrhash[ftr_id]] += 1
-            best_count = None
+        for expression_obj in expression_list:
+            row_index = expression_obj.data.index
+            best_count = 0
             best_genome = None
-            for genome_obj in genome_obj_count:
-                if best_genome == None or genome_obj_count[genome_obj] > best_count:
+            for genome_obj in genomes_to_models_hash:
+                count = row_index.isin(self.get_feature_index(genome_obj)).sum()
+                if count > best_count:
                     best_genome = genome_obj
-                    best_count = genome_obj_count[genome_obj]
+                    best_count = count
             if best_genome:
                 expression_objs[genomes_to_models_hash[best_genome]] = expression_obj.data    
         return expression_objs
@@ -186,36 +554,70 @@ class BaseModelingModule(BaseModule):
     def row_ids(self):
         return self.data.index.to_list()
 
+    def get_kbase_object(self,id_or_ref,ws=None,obj_type=None):
+        #Loads from the local object store when it is selected and holds the object, otherwise from the workspace
+        local_data = self.load_local_object(id_or_ref,ws,obj_type)
+        if local_data:
+            return KBaseObjectFactory().create({"data":[local_data]},None)
+        return self.kbase_api.get_from_ws(id_or_ref,ws)
+    
     def get_msgenome(self,id_or_ref,ws=None):
-        genome = self.kbase_api.get_from_ws(id_or_ref,ws)
+        genome = self.get_kbase_object(id_or_ref,ws,"KBaseGenomes.Genome")
         genome.id = genome.info.id
-        self.input_objects.append(genome.info.reference)
+        self.add_input_object(genome.info)
         return genome
     
     def get_media(self,id_or_ref,ws=None):
-        media = self.kbase_api.get_from_ws(id_or_ref,ws)
+        media = self.get_kbase_object(id_or_ref,ws,"KBaseBiochem.Media")
         media.id = media.info.id
-        self.input_objects.append(media.info.reference)
+        self.add_input_object(media.info)
         return media
     
+    def get_medias(self,id_or_refs,ws=None):
+        #Deduplicating references so repeated media are only fetched and built once
+        unique_refs = list(dict.fromkeys(id_or_refs))
+        if len(unique_refs) == 0:
+            return []
+        output = self.get_objects(unique_refs,ws,"KBaseBiochem.Media")
+        #Building media objects in parallel from the raw workspace data
+        factory = KBaseObjectFactory()
+        with ThreadPoolExecutor(max_workers=self.config["max_threads"]) as executor:
+            medias = list(executor.map(lambda ws_data: factory.create({"data":[ws_data]},None),output))
+        media_hash = {}
+        for i,ref in enumerate(unique_refs):
+            medias[i].id = medias[i].info.id
+            self.add_input_object(medias[i].info)
+            media_hash[ref] = medias[i]
+        return [media_hash[ref] for ref in id_or_refs]
+    
     def get_phenotypeset(self,id_or_ref,ws=None,base_media=None, base_uptake=0, base_excretion=1000,global_atom_limits={}):
-        kbphenoset = self.kbase_api.get_object(id_or_ref,ws)
+        kbphenoset = self.get_object(id_or_ref,ws,"KBasePhenotypes.PhenotypeSet")["data"]
         phenoset = MSGrowthPhenotypes.from_kbase_object(kbphenoset,self.kbase_api,base_media,base_uptake,base_excretion,global_atom_limits)
         return phenoset
     
     def get_model(self,id_or_ref,ws=None,is_json_file=False):
         if is_json_file:
             return MSModelUtil.build_from_kbase_json_file(id_or_ref)
-        mdlutl = MSModelUtil(self.kbase_api.get_from_ws(id_or_ref,ws))
+        mdlutl = MSModelUtil(self.get_kbase_object(id_or_ref,ws,"KBaseFBA.FBAModel"))
         mdlutl.wsid = mdlutl.model.info.id
-        self.input_objects.append(mdlutl.model.info.reference)
+        self.add_input_object(mdlutl.model.info)
         return mdlutl
     
-    def extend_model_with_other_ontologies(self,mdlutl,anno_ont,builder,prioritized_event_list=None,ontologies=None,merge_all=True):
+    def summarize_reaction_genes(self,gene_hash):
+        #Returns the gene IDs and best probability across all evidence supporting a reaction
+        probabilities = [item["scores"]["probability"] for gene in gene_hash for item in gene_hash[gene] if "scores" in item and "probability" in item["scores"]]
+        probability = None
+        if len(probabilities) > 0:
+            probability = max(probabilities)
+        return [gene.id for gene in gene_hash],probability
+    
+    def extend_model_with_other_ontologies(self,mdlutl,anno_ont,builder,prioritized_event_list=None,ontologies=None,merge_all=True,debug_file=False):
         gene_term_hash = anno_ont.get_gene_term_hash(
             prioritized_event_list, ontologies, merge_all, False
         )
-        self.print_json_debug_file("gene_term_hash",gene_term_hash)
+        if debug_file:
+            self.print_json_debug_file("gene_term_hash",gene_term_hash)
+        #Each term already carries its precomputed set of ModelSEED reactions
         residual_reaction_gene_hash = {}
         for gene in gene_term_hash:
             for term in gene_term_hash[gene]:
@@ -225,96 +627,93 @@ class BaseModelingModule(BaseModule):
                             residual_reaction_gene_hash[rxn_id] = {}
                         if gene not in residual_reaction_gene_hash[rxn_id]:
                             residual_reaction_gene_hash[rxn_id][gene] = []
-                        residual_reaction_gene_hash[rxn_id][gene] = gene_term_hash[gene][term]
+                        residual_reaction_gene_hash[rxn_id][gene].extend(gene_term_hash[gene][term])
+        #Partitioning candidate reactions into those already in the model and those that must be added
+        existing_rxn_ids = [rxn_id for rxn_id in residual_reaction_gene_hash if rxn_id + "_c0" in mdlutl.model.reactions]
+        new_rxn_ids = [rxn_id for rxn_id in residual_reaction_gene_hash if rxn_id + "_c0" not in mdlutl.model.reactions]
+        for rxn_id in existing_rxn_ids:
+            rxn = mdlutl.model.reactions.get_by_id(rxn_id + "_c0")
+            genes,probability = self.summarize_reaction_genes(residual_reaction_gene_hash[rxn_id])
+            if len(rxn.gene_reaction_rule) > 0:
+                genes.insert(0,rxn.gene_reaction_rule)
+            if probability != None and hasattr(rxn, "probability"):
+                rxn.probability = probability
+            rxn.gene_reaction_rule = " or ".join(genes)
 
-        reactions = []
+        staged_edit = StagedModelEdit(mdlutl.model)
         SBO_ANNOTATION = "sbo"
-        modelseeddb = ModelSEEDBiochem.get()
-        biochemdbrxn = False
-        for rxn_id in residual_reaction_gene_hash:
-            if rxn_id + "_c0" not in mdlutl.model.reactions:
-                reaction = None
-                template_reaction = None
-                if rxn_id + "_c" in mdlutl.model.template.reactions:
-                    template_reaction = mdlutl.model.template.reactions.get_by_id(rxn_id + "_c")
-                elif rxn_id in modelseeddb.reactions:
-                    rxnobj = modelseeddb.reactions.get_by_id(rxn_id)
-                    if "MI" not in rxnobj.status and "CI" not in rxnobj.status:
-                        #mdlutl.add_ms_reaction({rxn_id:"c0"}, compartment_trans=["c0", "e0"])
-                        template_reaction = rxnobj.to_template_reaction({0: "c", 1: "e"})
-                        biochemdbrxn = True
-                if template_reaction:
-                    for m in template_reaction.metabolites:
-                        if m.compartment not in builder.compartments:
-                            builder.compartments[
-                                m.compartment
-                            ] = builder.template.compartments.get_by_id(m.compartment)
-                        if m.id not in builder.template_species_to_model_species:
-                            model_metabolite = m.to_metabolite(builder.index)
-                            builder.template_species_to_model_species[
-                                m.id
-                            ] = model_metabolite
-                            builder.base_model.add_metabolites([model_metabolite])
-                    if biochemdbrxn:
-                        pass
-                        #template_reaction.add_metabolites({})
-                    reaction = template_reaction.to_reaction(
-                        builder.base_model, builder.index
-                    )
-                    gpr = ""
-                    probability = None
-                    for gene in residual_reaction_gene_hash[rxn_id]:
-                        for item in residual_reaction_gene_hash[rxn_id][gene]:
-                            if "scores" in item:
-                                if "probability" in item["scores"]:
-                                    if (
-                                        not probability
-                                        or item["scores"]["probability"] > probability
-                                    ):
-                                        probability = item["scores"]["probability"]
-                        if len(gpr) > 0:
-                            gpr += " or "
-                        gpr += gene.id
-                    if probability != None and hasattr(reaction, "probability"):
-                        reaction.probability = probability
-                    reaction.gene_reaction_rule = gpr
-                    reaction.annotation[SBO_ANNOTATION] = "SBO:0000176"
-                    reactions.append(reaction)
-                if not reaction:
-                    print("Reaction ", rxn_id, " not found in template or database!")
-            else:
-                rxn = mdlutl.model.reactions.get_by_id(rxn_id + "_c0")
-                gpr = rxn.gene_reaction_rule
-                probability = None
-                for gene in residual_reaction_gene_hash[rxn_id]:
-                    for item in residual_reaction_gene_hash[rxn_id][gene]:
-                        if "scores" in item:
-                            if "probability" in item["scores"]:
-                                if (
-                                    not probability
-                                    or item["scores"]["probability"] > probability
-                                ):
-                                    probability = item["scores"]["probability"]
-                    if len(gpr) > 0:
-                        gpr += " or "
-                    gpr += gene.id
-                if probability != None and hasattr(rxn, "probability"):
-                    rxn.probability = probability
-                rxn.gene_reaction_rule = gpr
-        mdlutl.model.add_reactions(reactions)
+        template_reactions = mdlutl.model.template.reactions
+        biochem_reactions = ModelSEEDBiochem.get().reactions
+        for rxn_id in new_rxn_ids:
+            template_reaction = None
+            if rxn_id + "_c" in template_reactions:
+                template_reaction = template_reactions.get_by_id(rxn_id + "_c")
+            elif rxn_id in biochem_reactions:
+                rxnobj = biochem_reactions.get_by_id(rxn_id)
+                if "MI" not in rxnobj.status and "CI" not in rxnobj.status:
+                    template_reaction = rxnobj.to_template_reaction({0: "c", 1: "e"})
+            if not template_reaction:
+                print("Reaction ", rxn_id, " not found in template or database!")
+                continue
+            for m in template_reaction.metabolites:
+                if m.compartment not in builder.compartments:
+                    builder.compartments[
+                        m.compartment
+                    ] = builder.template.compartments.get_by_id(m.compartment)
+                if m.id not in builder.template_species_to_model_species:
+                    model_metabolite = m.to_metabolite(builder.index)
+                    builder.template_species_to_model_species[
+                        m.id
+                    ] = model_metabolite
+                    staged_edit.add_metabolite(model_metabolite)
+            reaction = template_reaction.to_reaction(
+                builder.base_model, builder.index
+            )
+            genes,probability = self.summarize_reaction_genes(residual_reaction_gene_hash[rxn_id])
+            if probability != None and hasattr(reaction, "probability"):
+                reaction.probability = probability
+            reaction.gene_reaction_rule = " or ".join(genes)
+            reaction.annotation[SBO_ANNOTATION] = "SBO:0000176"
+            staged_edit.add_reaction(reaction)
+        staged_edit.apply()
         return mdlutl
     
     #################Classifier functions#####################
     def get_classifier(self):
-        cls_pickle = self.config["data"]+"/knn_ACNP_RAST_full_01_17_2023.pickle"
-        cls_features = self.config["data"]+"/knn_ACNP_RAST_full_01_17_2023_features.json"
-        #cls_pickle = self.module_dir+"/data/knn_ACNP_RAST_filter.pickle"
-        #cls_features = self.module_dir+"/data/knn_ACNP_RAST_filter_features.json"
-        with open(cls_pickle, 'rb') as fh:
-            model_filter = pickle.load(fh)
-        with open(cls_features, 'r') as fh:
-            features = json.load(fh)
-        return MSGenomeClassifier(model_filter, features)
+        cls_base = self.config["data"]+"/knn_ACNP_RAST_full_01_17_2023"
+        #cls_base = self.module_dir+"/data/knn_ACNP_RAST_filter"
+        #Classifier is cached at the process level so batch jobs only unpickle it once
+        if cls_base not in classifier_cache:
+            with open(cls_base+".pickle", 'rb') as fh:
+                model_filter = pickle.load(fh)
+            if self.config.get("classifier_format") == "npy" and exists(cls_base+"_features.npy"):
+                features = np.load(cls_base+"_features.npy",mmap_mode="r")
+            else:
+                with open(cls_base+"_features.json", 'r') as fh:
+                    features = json.load(fh)
+            classifier = MSGenomeClassifier(model_filter, features)
+            classifier.feature_index = {str(role):i for i,role in enumerate(features)}
+            classifier_cache[cls_base] = classifier
+        return classifier_cache[cls_base]
+    
+    def save_classifier_features_npy(self):
+        #Writes the compact feature file read by get_classifier when classifier_format is "npy"
+        classifier = self.get_classifier()
+        np.save(self.config["data"]+"/knn_ACNP_RAST_full_01_17_2023_features.npy",np.array(classifier.features,dtype=str))
+    
+    def classify_genomes(self,genomes,ontology_term="RAST"):
+        #Builds one indicator matrix for all genomes and runs a single prediction over it
+        if len(genomes) == 0:
+            return []
+        classifier = self.get_classifier()
+        matrix = np.zeros((len(genomes),len(classifier.feature_index)),dtype=int)
+        for i,genome in enumerate(genomes):
+            roles = genome
+            if isinstance(genome,MSGenome):
+                roles = MSGenomeClassifier.extract_features_from_genome(genome,ontology_term)["genome"]
+            columns = [classifier.feature_index[role] for role in roles if role in classifier.feature_index]
+            matrix[i,columns] = 1
+        return classifier.model.predict(matrix).tolist()
     
     #################Template functions#####################
     def get_gs_template(self,template_id,ws,core_template):
@@ -334,19 +733,104 @@ class BaseModelingModule(BaseModule):
         return gs_template
     
     def get_template(self,template_id,ws=None):
-        template = self.kbase_api.get_from_ws(template_id,ws)
+        template = self.get_kbase_object(template_id,ws,"KBaseFBA.NewModelTemplate")
         #template = self.kbase_api.get_object(template_id,ws)
         #info = self.kbase_api.get_object_info(template_id,ws)
         #template = MSTemplateBuilder.from_dict(template).build()
-        self.input_objects.append(template.info.reference)
+        self.add_input_object(template.info)
         return template
 
+    #################Simulation functions#####################
+    def simulation_condition(self,media_or_phenotype):
+        #Conditions are reduced to exchange bounds and gene knockouts so workers never see media objects
+        if hasattr(media_or_phenotype,"build_media"):
+            media = media_or_phenotype.build_media()
+            gene_ko = media_or_phenotype.gene_ko
+        else:
+            media = media_or_phenotype
+            gene_ko = []
+        return {"id":media_or_phenotype.id,"media":media.get_media_constraints(cmp="e0"),"gene_ko":gene_ko}
+    
+    def simulation_context(self,mdlutl):
+        #Use as a context manager so exchange bounds and solver settings are restored afterwards
+        return SimulationContext(mdlutl)
+    
+    def simulate_conditions(self,mdlutl,conditions,threads=None,save_fluxes=False,chunks_per_thread=4):
+        """
+        Runs FBA for a list of media or growth phenotypes in a pool of worker processes forked from
+        this one, each holding its own copy of the model. Returns a summary table of status and
+        objective value per condition and, if requested, a condition by reaction flux table.
+        """
+        if not threads:
+            threads = self.config["max_threads"]
+        condition_list = [self.simulation_condition(item) for item in conditions]
+        simulation_worker_state["mdlutl"] = mdlutl
+        simulation_worker_state["conditions"] = condition_list
+        simulation_worker_state["save_fluxes"] = save_fluxes
+        chunk_count = min(len(condition_list),threads*chunks_per_thread)
+        chunks = [list(range(i,len(condition_list),chunk_count)) for i in range(chunk_count)]
+        results = []
+        if threads == 1:
+            for chunk in chunks:
+                results += run_simulation_worker(chunk)
+        else:
+            with ProcessPoolExecutor(max_workers=threads,mp_context=multiprocessing.get_context("fork")) as executor:
+                for chunk_results in executor.map(run_simulation_worker,chunks):
+                    results += chunk_results
+        simulation_worker_state.clear()
+        results.sort(key=lambda result: result[0])
+        ids = [condition["id"] for condition in condition_list]
+        output = {"summary":pd.DataFrame({
+            "status":[result[1] for result in results],
+            "objective":[result[2] for result in results]
+        },index=ids),"fluxes":None}
+        if save_fluxes:
+            rxn_ids = [rxn.id for rxn in mdlutl.model.reactions]
+            fluxes = np.full((len(results),len(rxn_ids)),np.nan)
+            for i,result in enumerate(results):
+                if result[3] is not None:
+                    fluxes[i] = result[3]
+            output["fluxes"] = pd.DataFrame(fluxes,index=ids,columns=rxn_ids)
+        return output
+    
+    def simulation_solution(self,simulation,condition_id):
+        #Rebuilds a cobra solution for one condition so it can be passed to save_solution_as_fba
+        return cobra.Solution(
+            simulation["summary"].loc[condition_id,"objective"],
+            simulation["summary"].loc[condition_id,"status"],
+            fluxes=simulation["fluxes"].loc[condition_id]
+        )
+    
     #################Save functions#####################
-    def save_model(self,mdlutl,workspace=None,objid=None,suffix=None):
-        #Checking for zero flux reactions
+    def prepare_model_data(self,mdlutl,objid=None,suffix=None,gapfilling_data=True,report=None):
+        """
+        Builds save-ready FBAModel data. The serialized data and per-reaction fragments are cached on
+        the MSModelUtil, so later saves only reserialize reactions that were added or modified since
+        the last save. Edits to model fields outside reactions, compounds, compartments and attributes
+        are not detected, so callers making them should call invalidate_saved_data first. Zero flux
+        reactions, reaction changes and stage times are recorded in the report.
+        """
+        if report == None:
+            report = {}
+        timings = {}
+        report["timings"] = timings
+        #Converting first so change tracking always compares states of the serialized FBAModel reactions
+        start = time.time()
+        if not isinstance(mdlutl.model,FBAModel):
+            mdlutl.model = CobraModelConverter(mdlutl.model).build()
+        mdlutl.save_attributes()
+        timings["convert"] = time.time()-start
+        start = time.time()
+        #Single pass collecting zero flux reactions and the reaction state used for change tracking
+        zero_flux = []
+        rxn_state = {}
         for rxn in mdlutl.model.reactions:
             if rxn.lower_bound == 0 and rxn.upper_bound == 0:
-                print("Zero flux reaction: "+rxn.id)
+                zero_flux.append(rxn.id)
+            rxn_state[rxn.id] = self.model_reaction_state(rxn)
+        report["zero_flux_reactions"] = zero_flux
+        if len(zero_flux) > 0:
+            logger.info(str(len(zero_flux))+" zero flux reactions: "+", ".join(zero_flux[0:10])+("..." if len(zero_flux) > 10 else ""))
         #Setting the ID based on input
         if not suffix:
             suffix = ""
@@ -356,73 +840,174 @@ class BaseModelingModule(BaseModule):
             logger.critical("Must provide an ID to save a model!")
         objid = objid+suffix
         mdlutl.wsid = objid
-        #Saving attributes and getting model data
-        if not isinstance(mdlutl.model,FBAModel):
-            mdlutl.model = CobraModelConverter(mdlutl.model).build()
-        mdlutl.save_attributes()
-        data = mdlutl.model.get_data()
-        #If the workspace is None, then saving data to file
-        if not workspace:
+        timings["scan"] = time.time()-start
+        #Getting model data, reusing cached serialization where nothing it covers has changed
+        start = time.time()
+        other_state = self.model_other_state(mdlutl)
+        cache = getattr(mdlutl,"saved_data_cache",None)
+        data = None
+        if cache != None and cache["other_state"] == other_state:
+            report["changes"] = self.model_reaction_changes(cache["reactions"],rxn_state)
+            if sum(len(report["changes"][key]) for key in report["changes"]) == 0:
+                report["mode"] = "cached"
+                data = cache["data"]
+            else:
+                report["mode"] = "incremental"
+                data = self.patch_model_data(mdlutl,cache,report["changes"])
+        if data == None:
+            report["mode"] = "full"
+            data = mdlutl.model.get_data()
+        if report["mode"] != "cached":
+            mdlutl.saved_data_cache = {
+                "other_state":other_state,
+                "reactions":rxn_state,
+                "data":data,
+                "fragments":{rxn["id"]:rxn for rxn in data["modelreactions"]}
+            }
+        timings["serialize"] = time.time()-start
+        if gapfilling_data:
+            start = time.time()
+            #Gapfilling data is added to a structural copy so the cached data is never modified
+            data = dict(data)
+            data["gapfillings"] = list(data.get("gapfillings",[]))
+            data["modelreactions"] = [dict(rxn) for rxn in data["modelreactions"]]
+            for rxn in data["modelreactions"]:
+                if "gapfill_data" in rxn:
+                    rxn["gapfill_data"] = dict(rxn["gapfill_data"])
+            mdlutl.create_kb_gapfilling_data(data,self.config["ATP_media_workspace"])
+            timings["gapfilling"] = time.time()-start
+        return objid,data
+    
+    def model_reaction_state(self,rxn):
+        #Covers every reaction field ModelReaction._to_json and biomass serialization write out
+        proteins = getattr(rxn,"model_reaction_proteins",None)
+        return (
+            rxn.lower_bound,
+            rxn.upper_bound,
+            rxn.gene_reaction_rule,
+            rxn.name,
+            tuple(sorted((met.id,coef) for met,coef in rxn.metabolites.items())),
+            getattr(rxn,"compartment",None),
+            getattr(rxn,"probability",None),
+            getattr(rxn,"protons",None),
+            json.dumps([getattr(rxn,"imported_gpr",None),getattr(rxn,"string_attributes",None),getattr(rxn,"numerical_attributes",None)],sort_keys=True,default=str),
+            json.dumps([o.get_data() for o in proteins] if proteins else None,sort_keys=True,default=str)
+        )
+    
+    def model_other_state(self,mdlutl):
+        #Fingerprint of the non-reaction content get_data serializes: compounds, compartments and attributes
+        compounds = [(met.id,met.name,met.formula,met.charge,met.compartment) for met in mdlutl.model.metabolites]
+        return hash((
+            json.dumps(compounds,default=str),
+            json.dumps(mdlutl.model.compartments,sort_keys=True,default=str),
+            json.dumps(mdlutl.attributes,sort_keys=True,default=str)
+        ))
+    
+    def invalidate_saved_data(self,mdlutl):
+        #Forces the next save to run a full get_data after edits the fingerprints do not cover
+        if hasattr(mdlutl,"saved_data_cache"):
+            del mdlutl.saved_data_cache
+    
+    def model_reaction_changes(self,old_state,new_state):
+        changes = {"added":[],"removed":[],"modified":[]}
+        for rxn_id in new_state:
+            if rxn_id not in old_state:
+                changes["added"].append(rxn_id)
+            elif new_state[rxn_id] != old_state[rxn_id]:
+                changes["modified"].append(rxn_id)
+        changes["removed"] = [rxn_id for rxn_id in old_state if rxn_id not in new_state]
+        return changes
+    
+    def serialize_model_reaction(self,reaction):
+        #Mirrors how FBAModel.get_data serializes a single metabolic reaction
+        if type(reaction) is ModelReaction:
+            return reaction._to_json()
+        return ModelReaction.from_cobra_reaction(reaction)._to_json()
+    
+    def patch_model_data(self,mdlutl,cache,changes):
+        #Returns None when a change touches biomass or drain reactions, which need a full get_data
+        changed = set(changes["added"]+changes["modified"])
+        for rxn_id in changes["removed"]:
+            if rxn_id not in cache["fragments"]:
+                return None
+        modelreactions = []
+        for rxn in mdlutl.model.reactions:
+            if rxn.id in changed:
+                if CobraModelConverter.reaction_is_drain(rxn) or CobraModelConverter.reaction_is_biomass(rxn):
+                    return None
+                modelreactions.append(self.serialize_model_reaction(rxn))
+            elif rxn.id in cache["fragments"]:
+                modelreactions.append(cache["fragments"][rxn.id])
+        data = dict(cache["data"])
+        data["modelreactions"] = modelreactions
+        return data
+    
+    def save_model(self,mdlutl,workspace=None,objid=None,suffix=None):
+        report = {}
+        objid,data = self.prepare_model_data(mdlutl,objid,suffix,gapfilling_data=workspace != None or self.use_local_store(),report=report)
+        start = time.time()
+        #If the workspace is None and no local store is selected, then saving data to debug file
+        if not workspace and not self.use_local_store():
             self.print_json_debug_file(mdlutl.wsid+".json",data)
         else:
-            #Setting the workspace
-            if workspace:
-                self.set_ws(workspace)
             #Setting provenance and saving model using workspace API
-            mdlutl.create_kb_gapfilling_data(data,self.config["ATP_media_workspace"])
-            params = {
-                'id':self.ws_id,
-                'objects': [{
-                    'data': data,
-                    'name': objid,
-                    'type': "KBaseFBA.FBAModel",
-                    'meta': {},
-                    'provenance': self.provenance()
-                }]
-            }
-            self.ws_client().save_objects(params)
-            self.obj_created.append({"ref":self.create_ref(objid,self.ws_name),"description":""})
+            self.save_ws_objects([(objid,data,"KBaseFBA.FBAModel")],workspace)
+        report["timings"]["save"] = time.time()-start
+        report["id"] = objid
+        if "changes" in report:
+            logger.info("Model "+objid+" changes since last save: "+", ".join([key+":"+str(len(report["changes"][key])) for key in report["changes"]]))
+        logger.info("Saved model "+objid+" ["+report["mode"]+"] ("+", ".join([stage+":"+"%.2fs" % report["timings"][stage] for stage in report["timings"]])+")")
+        return report
+    
+    def benchmark_model_saves(self,mdlutl,rounds=10,changes_per_round=5):
+        """
+        Measures repeated-save throughput of prepare_model_data with and without the reaction fragment
+        cache. Each round changes the bounds of a few reactions, as an iterative gapfilling loop would.
+        Original bounds and workspace ID are restored afterwards.
+        """
+        original_wsid = mdlutl.wsid
+        objid = mdlutl.wsid or mdlutl.model.id
+        #Preparing once up front so the reactions changed below belong to the converted FBAModel
+        self.prepare_model_data(mdlutl,objid=objid,gapfilling_data=False)
+        reactions = [rxn for rxn in mdlutl.model.reactions if not CobraModelConverter.reaction_is_drain(rxn) and not CobraModelConverter.reaction_is_biomass(rxn)]
+        original_bounds = [rxn.bounds for rxn in reactions]
+        output = {}
+        try:
+            for mode in ["full","incremental"]:
+                self.invalidate_saved_data(mdlutl)
+                self.prepare_model_data(mdlutl,objid=objid,gapfilling_data=False)
+                start = time.time()
+                for i in range(rounds):
+                    for j in range(changes_per_round):
+                        rxn = reactions[(i*changes_per_round+j) % len(reactions)]
+                        rxn.upper_bound = rxn.upper_bound+1
+                    if mode == "full":
+                        self.invalidate_saved_data(mdlutl)
+                    self.prepare_model_data(mdlutl,objid=objid,gapfilling_data=False)
+                elapsed = time.time()-start
+                output[mode] = {"seconds":elapsed,"saves_per_second":rounds/elapsed if elapsed > 0 else None}
+        finally:
+            for i,rxn in enumerate(reactions):
+                rxn.bounds = original_bounds[i]
+            mdlutl.wsid = original_wsid
+        logger.info("Repeated save benchmark: "+json.dumps(output))
+        return output
     
     def save_phenotypeset(self,data,workspace,objid):
-        self.set_ws(workspace)
-        params = {
-            'id':self.ws_id,
-            'objects': [{
-                'data': data,
-                'name': objid,
-                'type': "KBasePhenotypes.PhenotypeSet",
-                'meta': {},
-                'provenance': self.provenance()
-            }]
-        }
-        self.ws_client().save_objects(params)
-        self.obj_created.append({"ref":self.create_ref(objid,self.ws_name),"description":""})
+        self.save_ws_objects([(objid,data,"KBasePhenotypes.PhenotypeSet")],workspace)
 
     def save_solution_as_fba(self,fba_or_solution,mdlutl,media,fbaid,workspace=None,fbamodel_ref=None,other_solutions=None):
         if not isinstance(fba_or_solution,MSFBA):
             fba_or_solution = MSFBA(mdlutl,media,primary_solution=fba_or_solution)
         fba_or_solution.id = fbaid
-        if other_solutions != None:
+        if other_solutions != None and not isinstance(other_solutions,FBASolutionSet):
             for other_solution in other_solutions:
                 fba_or_solution.add_secondary_solution(other_solution)
         data = fba_or_solution.generate_kbase_data(fbamodel_ref,media.info.reference)
-        #If the workspace is None, then saving data to file
-        if not workspace and self.util:
-            self.util.save(fbaid,data)
+        if isinstance(other_solutions,FBASolutionSet):
+            other_solutions.fill_kbase_variables(data)
+        #If the workspace is None and no local store is selected, then saving data to debug file
+        if not workspace and not self.use_local_store():
+            self.print_json_debug_file(fbaid+".json",data)
         else:
-            #Setting the workspace
-            if workspace:
-                self.set_ws(workspace)
-            #Setting provenance and saving model using workspace API
-            params = {
-                'id':self.ws_id,
-                'objects': [{
-                    'data': data,
-                    'name': fbaid,
-                    'type': "KBaseFBA.FBA",
-                    'meta': {},
-                    'provenance': self.provenance()
-                }]
-            }
-            self.ws_client().save_objects(params)
-            self.obj_created.append({"ref":self.create_ref(fbaid,self.ws_name),"description":""})
\ No newline at end of file
+            self.save_ws_objects([(fbaid,data,"KBaseFBA.FBA")],workspace)
\ No newline at end of file
@@ -8,6 +8,7 @@ import re
 import time
 import sys
 import uuid
+import gzip
 import requests
 from os.path import exists
 #from json import JSONEncoder
@@ -20,6 +21,79 @@ logger.setLevel(
     logging.INFO
 ) 
 
+class LocalObjectStore:
+    """
+    Directory of compressed JSON or msgpack files keyed by object type, workspace and ID, used in
+    place of the workspace so large batch runs can checkpoint at disk speed and upload in bulk at the end
+    """
+    def __init__(self,directory,format="json.gz"):
+        self.directory = directory
+        self.format = format
+        os.makedirs(directory, exist_ok=True)
+    
+    def path(self,workspace,objid,obj_type):
+        return self.directory+"/"+obj_type.split("-")[0]+"/"+str(workspace)+"/"+objid+"."+self.format
+    
+    def find_types(self,workspace,objid):
+        return [obj_type for obj_type in sorted(os.listdir(self.directory)) if exists(self.path(workspace,objid,obj_type))]
+    
+    def exists(self,workspace,objid,obj_type=None):
+        if not obj_type:
+            return len(self.find_types(workspace,objid)) > 0
+        return exists(self.path(workspace,objid,obj_type))
+    
+    def write(self,filename,record):
+        if self.format == "msgpack":
+            import msgpack
+            with open(filename, 'wb') as f:
+                f.write(msgpack.packb(record))
+        else:
+            with gzip.open(filename, 'wt') as f:
+                json.dump(record, f, skipkeys=True)
+    
+    def read(self,filename):
+        if self.format == "msgpack":
+            import msgpack
+            with open(filename, 'rb') as f:
+                return msgpack.unpackb(f.read())
+        with gzip.open(filename, 'rt') as f:
+            return json.load(f)
+    
+    def save(self,workspace,objid,obj_type,data,meta={}):
+        #Records use the workspace get_objects2 layout so loaders can treat them like workspace output,
+        #with "local" as the owner marking objects that have no workspace reference yet
+        filename = self.path(workspace,objid,obj_type)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        version = 1
+        if exists(filename):
+            version = self.read(filename)["info"][4]+1
+        info = [objid,objid,obj_type,time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime()),version,"local",str(workspace),self.directory,None,None,meta]
+        self.write(filename,{"data":data,"info":info})
+        return info
+    
+    def load(self,workspace,objid,obj_type=None):
+        if not obj_type:
+            obj_types = self.find_types(workspace,objid)
+            if len(obj_types) == 0:
+                return None
+            if len(obj_types) > 1:
+                raise ValueError("Local object "+str(workspace)+"/"+objid+" exists with types "+", ".join(obj_types)+"! Specify the object type.")
+            obj_type = obj_types[0]
+        if not exists(self.path(workspace,objid,obj_type)):
+            return None
+        return self.read(self.path(workspace,objid,obj_type))
+    
+    def list(self,obj_type=None):
+        #Returns (workspace,objid,obj_type) for every stored object, optionally filtered by type
+        output = []
+        for type_dir in sorted(os.listdir(self.directory)):
+            if not obj_type or obj_type.split("-")[0] == type_dir:
+                for workspace in sorted(os.listdir(self.directory+"/"+type_dir)):
+                    for fname in sorted(os.listdir(self.directory+"/"+type_dir+"/"+workspace)):
+                        if fname.endswith("."+self.format):
+                            output.append((workspace,fname[0:-len(self.format)-1],type_dir))
+        return output
+
 class BaseModule:
     def __init__(self,name,config,module_dir="/kb/module",working_dir=None,token=None,clients={},callback=None):
         #Initializing flexible container for client libraries which will be lazy loaded as needed
@@ -32,9 +106,13 @@ class BaseModule:
         self.config = config
         self.validate_args(self.config,[],{
             "max_retry":3,
+            "max_threads":8,
+            "object_store":"workspace",
+            "local_store_format":"json.gz",
             "workspace-url":"https://kbase.us/services/ws",
         })
         self.cached_to_obj_path = {}
+        self.local_object_store = None
         self.token = token
         self.name = name
         self.module_dir = module_dir
@@ -158,6 +236,17 @@ class BaseModule:
             self.clients["HandleService"] = HandleService("https://kbase.us/services/handle_service", token=self.token)
         return self.clients["HandleService"]
 
+    def local_store(self):
+        if not self.local_object_store:
+            directory = self.config.get("local_store_directory")
+            if not directory:
+                directory = self.working_dir+"/objects"
+            self.local_object_store = LocalObjectStore(directory,self.config["local_store_format"])
+        return self.local_object_store
+    
+    def use_local_store(self):
+        return self.config["object_store"] == "local"
+
     #########GENERAL UTILITY FUNCTIONS#######################
     def process_genome_list(self,input_references,workspace=None):
         ws_identities = []
@@ -328,13 +417,67 @@ class BaseModule:
         ws_identities = [self.process_ws_ids(id_or_ref, ws)]
         return self.ws_client().get_object_info(ws_identities,1)[0]
 
-    def get_object(self, id_or_ref, ws=None):
+    def local_key(self,id_or_ref,ws=None):
+        #Local objects are keyed by workspace and name exactly as given, so only references carrying an
+        #object name can resolve locally, and objects saved without a workspace are keyed under "local".
+        #The version is None unless the reference pins one.
+        array = id_or_ref.split(";")[-1].split("/")
+        if len(array) > 2:
+            return array[0],array[1],int(array[2])
+        if len(array) > 1:
+            return array[0],array[1],None
+        if ws == None:
+            ws = "local"
+        return str(ws),array[0],None
+    
+    def load_local_object(self,id_or_ref,ws=None,obj_type=None):
+        #Returns the local store record for the reference, or None when the local store is off, lacks it,
+        #or only holds a different version than the reference pins, so the load falls back to the workspace
+        if not self.use_local_store() or not isinstance(id_or_ref,str):
+            return None
+        (workspace,objid,version) = self.local_key(id_or_ref,ws)
+        output = self.local_store().load(workspace,objid,obj_type)
+        if output and version != None and output["info"][4] != version:
+            return None
+        return output
+    
+    def add_input_object(self,info):
+        #Local store objects have no workspace reference, so they are left out of provenance
+        if isinstance(info,list):
+            if info[5] != "local":
+                self.input_objects.append(self.wsinfo_to_ref(info))
+        elif info.user != "local":
+            self.input_objects.append(info.reference)
+    
+    def get_object(self, id_or_ref, ws=None, obj_type=None):
+        output = self.load_local_object(id_or_ref,ws,obj_type)
+        if output:
+            return output
         res = self.ws_get_objects({"objects": [self.process_ws_ids(id_or_ref, ws)]})
         if res is None:
             return None
         return res["data"][0]
     
+    def get_objects(self, id_or_refs, ws=None, obj_type=None):
+        """
+        Retrieves objects in the get_objects2 layout, loading any found in the local store from disk
+        and the rest from the workspace in a single batched call
+        """
+        output = [None]*len(id_or_refs)
+        ws_indices = []
+        for i,id_or_ref in enumerate(id_or_refs):
+            output[i] = self.load_local_object(id_or_ref,ws,obj_type)
+            if not output[i]:
+                ws_indices.append(i)
+        if len(ws_indices) > 0:
+            res = self.ws_get_objects({"objects":[self.process_ws_ids(id_or_refs[i],ws) for i in ws_indices]})
+            for j,i in enumerate(ws_indices):
+                output[i] = res["data"][j]
+        return output
+    
     def save_genome_or_metagenome(self,objid,workspace,obj_json):
+        if self.use_local_store():
+            return self.local_store().save(workspace if workspace else "local",objid,"KBaseGenomes.Genome",obj_json)
         self.set_ws(workspace)
         save_output = self.gfu_client().save_one_genome({
             "name" : objid,
@@ -348,19 +491,60 @@ class BaseModule:
         return save_output["info"]
     
     def save_ws_object(self,objid,workspace,obj_json,obj_type):
+        return self.save_ws_objects([(objid,obj_json,obj_type)],workspace)
+    
+    def save_ws_objects(self,obj_list,workspace,chunk_size=100,use_local=None):
+        """
+        Saves a list of (objid,obj_json,obj_type) tuples with one save_objects call per chunk,
+        or to the local object store when it is selected in the config
+        """
+        if use_local == None:
+            use_local = self.use_local_store()
+        if use_local:
+            if not workspace:
+                workspace = "local"
+            return [self.local_store().save(workspace,objid,obj_type,obj_json) for (objid,obj_json,obj_type) in obj_list]
         self.set_ws(workspace)
-        params = {
-            'id':self.ws_id,
-            'objects': [{
-                'data': obj_json,
-                'name': objid,
-                'type': obj_type,
-                'meta': {},
-                'provenance': self.provenance()
-            }]
-        }
-        self.obj_created.append({"ref":self.create_ref(objid,self.ws_name),"description":""})
-        return self.ws_client().save_objects(params)
+        infos = []
+        for i in range(0,len(obj_list),chunk_size):
+            params = {
+                'id':self.ws_id,
+                'objects': []
+            }
+            for (objid,obj_json,obj_type) in obj_list[i:i+chunk_size]:
+                params["objects"].append({
+                    'data': obj_json,
+                    'name': objid,
+                    'type': obj_type,
+                    'meta': {},
+                    'provenance': self.provenance()
+                })
+                self.obj_created.append({"ref":self.create_ref(objid,self.ws_name),"description":""})
+            infos += self.ws_client().save_objects(params)
+        return infos
+    
+    def upload_local_objects(self,workspace=None,obj_type=None,chunk_size=100):
+        """
+        Uploads everything checkpointed in the local object store in chunked calls, either all into the
+        specified workspace or each into the workspace it was stored under
+        """
+        ws_stored = {}
+        for (stored_ws,objid,stored_type) in self.local_store().list(obj_type):
+            target = workspace
+            if not target:
+                if stored_ws == "local":
+                    raise ValueError("Local object "+objid+" was saved without a workspace! Specify the upload workspace.")
+                target = stored_ws
+            ws_stored.setdefault(target,[]).append((stored_ws,objid,stored_type))
+        infos = []
+        for target in ws_stored:
+            stored = ws_stored[target]
+            for i in range(0,len(stored),chunk_size):
+                obj_list = []
+                for (stored_ws,objid,stored_type) in stored[i:i+chunk_size]:
+                    obj_list.append((objid,self.local_store().load(stored_ws,objid,stored_type)["data"],stored_type))
+                infos += self.save_ws_objects(obj_list,target,chunk_size,use_local=False)
+        return infos
     
     def wsinfo_to_ref(self,info):
         return str(info[6])+"/"+str(info[0])+"/"+str(info[4])
@@ -434,7 +618,10 @@ class BaseModule:
         })
         return {"report_name":report_name,"report_ref":output["ref"],'workspace_name':self.ws_name}
     
-    def build_dataframe_report(self,table,column_list):        
+    def build_dataframe_report(self,table,column_list,paging_threshold=50000,page_size=5000):
+        #Tables over paging_threshold rows are written as compressed pages of page_size rows
+        if len(table) > paging_threshold:
+            return self.build_paged_dataframe_report(table,column_list,page_size)
         #Convert columns to this format:
         columns = []
         for item in column_list:
@@ -468,4 +655,77 @@ class BaseModule:
         with open(self.working_dir+"/html/index.html", 'w') as f:
             f.write(html_data)
         with open(self.working_dir+"/html/data.json", 'w') as f:
-            f.write(json_str)
\ No newline at end of file
+            f.write(json_str)
+    
+    def build_paged_dataframe_report(self,table,column_list,page_size=5000):
+        """
+        Writes the table as gzip-compressed JSON pages of row arrays under html/data, with a DataTables
+        page that fetches and decompresses only the pages needed for the rows on display
+        """
+        os.makedirs(self.working_dir+"/html/data", exist_ok=True)
+        table = table[column_list]
+        pages = 0
+        for start in range(0,len(table),page_size):
+            json_str = table.iloc[start:start+page_size].to_json(orient='values')
+            with open(self.working_dir+"/html/data/page"+str(pages)+".json.gz", 'wb') as f:
+                f.write(gzip.compress(json_str.encode("utf-8"),compresslevel=6))
+            pages += 1
+        manifest = {"rows":len(table),"page_size":page_size,"pages":pages}
+        columns = []
+        for i,item in enumerate(column_list):
+            columns.append({"data":i,"title":item})
+        html_data = """
+    <html>
+    <header>
+        <link href="https://cdn.datatables.net/1.11.5/css/jquery.dataTables.min.css" rel="stylesheet">
+    </header>
+    <body>
+    <table id="example" class="display" style="width:100%"></table>
+    <script src="https://code.jquery.com/jquery-3.6.0.slim.min.js" integrity="sha256-u7e5khyithlIdTpu22PHhENmPcRdFiHRjhAuHcs05RI=" crossorigin="anonymous"></script>
+    <script type="text/javascript" src="https://cdn.datatables.net/1.11.5/js/jquery.dataTables.min.js"></script>
+    <script>
+        var manifest = """+json.dumps(manifest)+""";
+        var pages = {};
+        function loadPage(index) {
+            if (!(index in pages)) {
+                pages[index] = fetch("data/page" + index + ".json.gz").then(function(response) {
+                    var stream = response.body.pipeThrough(new DecompressionStream("gzip"));
+                    return new Response(stream).json();
+                });
+            }
+            return pages[index];
+        }
+        $(document).ready(function() {
+            $('#example').DataTable( {
+                "serverSide": true,
+                "searching": false,
+                "ordering": false,
+                "deferRender": true,
+                "ajax": function(request, callback) {
+                    var first = Math.floor(request.start / manifest.page_size);
+                    var last = Math.min(Math.floor((request.start + request.length - 1) / manifest.page_size), manifest.pages - 1);
+                    var requests = [];
+                    for (var i = first; i <= last; i++) {
+                        requests.push(loadPage(i));
+                    }
+                    Promise.all(requests).then(function(results) {
+                        var rows = [].concat.apply([], results);
+                        var offset = request.start - first * manifest.page_size;
+                        callback({
+                            "draw": request.draw,
+                            "recordsTotal": manifest.rows,
+                            "recordsFiltered": manifest.rows,
+                            "data": rows.slice(offset, offset + request.length)
+                        });
+                    });
+                },
+                "columns": """+json.dumps(columns,indent=4)+"""
+            } );
+        } );
+    </script>
+    </body>
+    </html>
+    """
+        with open(self.working_dir+"/html/index.html", 'w') as f:
+            f.write(html_data)
+        return manifest
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Letters of the IUPAC protein alphabet formerly provided by Bio.Alphabet.IUPAC.protein
+protein_letters = "ACDEFGHIKLMNPQRSTVWY"
+protein_bytes = protein_letters.encode("ascii")
+#Translation table marking every byte outside the alphabet with 1 and every protein letter with 0
+invalid_byte_table = bytes(0 if chr(i) in protein_letters else 1 for i in range(256))
+
+def encode_protein(seq):
+    #Non-ASCII characters become "?" so they can never pass validation
+    if isinstance(seq,bytes):
+        return seq
+    return seq.encode("ascii","replace")
+
+def is_valid_protein(seq):
+    """Returns True if the sequence is nonempty and uses only IUPAC protein letters"""
+    seq = encode_protein(seq)
+    return len(seq) > 0 and len(seq.translate(None,protein_bytes)) == 0
+
+def validate_proteins(seqs):
+    """Validates a list of sequences in bulk and returns a boolean numpy array
+
+    All sequences are concatenated into one buffer and translated into an invalid-character mask
+    in a single pass, so only the positions of invalid characters are mapped back to sequences
+    """
+    if all(isinstance(seq,str) for seq in seqs):
+        #Encoding with replacement keeps one byte per character, so string lengths still apply
+        buffer = "".join(seqs).encode("ascii","replace")
+    else:
+        buffer = b"".join(encode_protein(seq) for seq in seqs)
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+    output = lengths > 0
+    invalid = np.flatnonzero(np.frombuffer(buffer.translate(invalid_byte_table), dtype=np.uint8))
+    if len(invalid) > 0:
+        output[np.searchsorted(np.cumsum(lengths),invalid,side="right")] = False
+    return output
+
+def benchmark_validation(count=1000000,length=300,invalid_fraction=0.01,seed=0):
+    """Times per-sequence translate and bulk numpy validation over randomly generated proteins"""
+    rng = np.random.default_rng(seed)
+    letters = np.frombuffer(protein_bytes, dtype=np.uint8)
+    buffer = letters[rng.integers(0,len(letters),size=count*length)]
+    buffer[rng.choice(count,int(count*invalid_fraction),replace=False)*length] = ord("*")
+    data = buffer.tobytes()
+    seqs = [data[i*length:(i+1)*length].decode("ascii") for i in range(count)]
+    output = {"count":count,"length":length}
+    start = time.time()
+    translate_result = [is_valid_protein(seq) for seq in seqs]
+    output["translate_seconds"] = time.time()-start
+    start = time.time()
+    numpy_result = validate_proteins(seqs)
+    output["numpy_seconds"] = time.time()-start
+    output["invalid"] = int(count-numpy_result.sum())
+    if numpy_result.tolist() != translate_result:
+        logger.warning("Translate and numpy protein validation disagree!")
+    logger.info("Protein validation benchmark: %s", output)
+    return output